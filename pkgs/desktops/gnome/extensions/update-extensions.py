@@ -1,16 +1,25 @@
 #!/usr/bin/env nix-shell
-#!nix-shell -I nixpkgs=../../../.. -i python3 -p python3
+#!nix-shell -I nixpkgs=../../../.. -i python3 -p "python3.withPackages (ps: with ps; [ orjson urllib3 ])"
 
+import argparse
 import base64
-import json
+import concurrent.futures
+import functools
+import io
 import logging
+import orjson
+import os
+import re
 import subprocess
-import urllib.error
-import urllib.request
+import tempfile
+import threading
+import urllib3
+import zipfile
+from collections import defaultdict
 from contextlib import contextmanager
 from operator import itemgetter
 from pathlib import Path
-from typing import List, Dict, Optional, Any, Tuple, Set
+from typing import List, Dict, DefaultDict, Optional, Any, Tuple, Set, BinaryIO
 
 # We don't want all those deprecated legacy extensions
 # Group extensions by GNOME "major" version for compatibility reasons
@@ -26,6 +35,9 @@ supported_versions = {
     "47": "47",
 }
 
+# Reverse lookup of `supported_versions`, from version prefix to shell version
+shell_version_by_prefix = {prefix: shell_version for shell_version, prefix in supported_versions.items()}
+
 # Some type alias to increase readability of complex compound types
 PackageName = str
 ShellVersion = str
@@ -36,89 +48,177 @@ ExtensionVersion = int
 # This works because we deterministically process all extensions in historical order
 # The outer dict level is the shell version, as we are tracking duplicates only per same Shell version.
 # key: shell version, value: Dict with key: pname, value: list of UUIDs with that pname
-package_name_registry: Dict[ShellVersion, Dict[PackageName, List[Uuid]]] = {}
+package_name_registry: Dict[ShellVersion, DefaultDict[PackageName, List[Uuid]]] = {}
 for shell_version in supported_versions.keys():
-    package_name_registry[shell_version] = {}
+    package_name_registry[shell_version] = defaultdict(list)
 
 updater_dir_path = Path(__file__).resolve().parent
 
+# Extension links look like "/extension/$number/$string/"
+extension_link_pattern = re.compile(r"^/extension/(\d+)/([^/]+)")
+
+# All traffic goes to extensions.gnome.org, so share keep-alive connections between all requests and threads.
+# The read timeout applies to every single socket read, so it aborts stalled downloads (which are then retried).
+http_pool = urllib3.PoolManager(
+    num_pools=2, maxsize=32, block=True, timeout=urllib3.Timeout(connect=30, read=60)
+)
+
+# Cache the downloaded data across runs, so that only new extension versions need to be downloaded.
+# As the downloads are impure (see `generate_extension_versions`), this also keeps the pinned metadata.json
+# of known versions. Run with `--refresh` to ignore all cached data and download everything again.
+# key: "uuid@version", value: (sha256, metadata)
+download_cache_path = (
+    Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "nixpkgs-gnome-extensions" / "download_cache.json"
+)
+download_cache: Dict[str, Tuple[str, str]] = {}
+download_cache_lock = threading.Lock()
+
+
+def load_download_cache() -> None:
+    """
+    Fill `download_cache` from disk. The current extensions.json is used as well, so that a missing cache file
+    still results in a warm cache.
+    """
+    try:
+        with open(updater_dir_path / "extensions.json", "rb") as out:
+            for extension in orjson.loads(out.read()):
+                for data in extension["shell_version_map"].values():
+                    download_cache[f"{extension['uuid']}@{data['version']}"] = (data["sha256"], data["metadata"])
+    except FileNotFoundError:
+        pass
+
+    try:
+        with open(download_cache_path, "rb") as out:
+            for key, (sha256, metadata) in orjson.loads(out.read()).items():
+                download_cache[key] = (sha256, metadata)
+    except FileNotFoundError:
+        pass
+
+
+def save_download_cache() -> None:
+    """
+    Write `download_cache` to disk atomically, so that an interrupted run never leaves a corrupt cache behind.
+    """
+    download_cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = download_cache_path.with_suffix(".json.tmp")
+    with download_cache_lock:
+        with open(tmp_path, "wb") as out:
+            out.write(orjson.dumps(download_cache))
+    os.replace(tmp_path, download_cache_path)
+
 
 def fetch_extension_data(uuid: str, version: str) -> Tuple[str, str]:
     """
-    Download the extension and hash it. We use `nix-prefetch-url` for this for efficiency reasons.
+    Download the extension and hash it. The zip is downloaded in-process, and hashed with `nix-prefetch-url --unpack` from a local copy,
+    so the hash is computed exactly like `fetchzip` expects it.
     Returns a tuple with the hash (Nix-compatible) of the zip file's content and the base64-encoded content of its metadata.json.
     """
 
+    cache_key = f"{uuid}@{version}"
+    with download_cache_lock:
+        if cache_key in download_cache:
+            return download_cache[cache_key]
+
+    logging.debug(f"[{uuid}] Downloading v{version}")
+
     # The download URLs follow this schema
     uuid = uuid.replace("@", "")
     url: str = f"https://extensions.gnome.org/extension-data/{uuid}.v{version}.shell-extension.zip"
 
-    # Download extension and add the zip content to nix-store
-    for _ in range(0, 10):
-        process = subprocess.run(
-            ["nix-prefetch-url", "--unpack", "--print-path", url], capture_output=True, text=True
-        )
-        if process.returncode == 0:
+    # Retry the whole download, as reading the body can fail as well (e.g. on a connection reset)
+    for attempt in range(1, 11):
+        try:
+            with request(url) as response:
+                if response.status != 200:
+                    raise Exception(f"Failed to download {url}: HTTP {response.status}. Exiting.")
+                # Read the body in large chunks instead of many small socket reads
+                data = b"".join(response.stream(1 << 16))
             break
-        else:
-            logging.warning(f"Nix-prefetch-url failed for {url}:")
-            logging.warning(f"Stderr: {process.stderr}")
-            logging.warning(f"Retrying")
+        except urllib3.exceptions.HTTPError as e:
+            if attempt == 10:
+                raise Exception("Retried 10 times, but still failed to download the extension. Exiting.") from e
+            logging.warning(f"Downloading {url} failed: {e}")
+            logging.warning("Retrying")
+
+    # Get metadata.json content directly from the archive
+    with zipfile.ZipFile(io.BytesIO(data)) as zip_file:
+        with io.TextIOWrapper(zip_file.open("metadata.json"), encoding="ascii") as out:
+            metadata = base64.b64encode(out.read().encode("ascii")).decode()
+
+    # Let Nix unpack and hash the downloaded file, instead of downloading it a second time
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / url.rsplit("/", 1)[1]
+        path.write_bytes(data)
+        command = ["nix-prefetch-url", "--unpack", path.as_uri()]
+        # Only capture stderr when something went wrong, to get the diagnostics
+        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if process.returncode != 0:
+            process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
     if process.returncode != 0:
-        raise Exception("Retried 10 times, but still failed to download the extension. Exiting.")
-
-    lines = process.stdout.splitlines()
+        logging.warning(f"Stderr: {process.stderr.decode()}")
+        raise Exception(f"nix-prefetch-url failed for {url}. Exiting.")
 
     # Get hash from first line of nix-prefetch-url output
-    hash = lines[0].strip()
+    hash = process.stdout.decode().splitlines()[0].strip()
 
-    # Get path from second line of nix-prefetch-url output
-    path = Path(lines[1].strip())
-
-    # Get metadata.json content from nix-store
-    with open(path / "metadata.json", "r") as out:
-        metadata = base64.b64encode(out.read().encode("ascii")).decode()
+    with download_cache_lock:
+        download_cache[cache_key] = (hash, metadata)
 
     return hash, metadata
 
 
+def version_prefix(shell_version: str) -> str:
+    """
+    Get the part of a GNOME Shell version that identifies its "major" version, as used in `supported_versions`:
+    "3.38.1" becomes "3.38", while "40.beta" becomes "40".
+    """
+    parts = shell_version.split(".")
+    if parts[0] == "3":
+        return ".".join(parts[:2])
+    return parts[0]
+
+
 def generate_extension_versions(
-        extension_version_map: Dict[ShellVersion, ExtensionVersion], uuid: str
+        extension_version_map: Dict[ShellVersion, Dict[str, Any]], uuid: str
 ) -> Dict[ShellVersion, Dict[str, str]]:
     """
-    Takes in a mapping from shell versions to extension versions and transforms it the way we need it:
+    Takes in the scraped mapping from shell versions to extension version data ({ "version": int, … })
+    and transforms it the way we need it:
     - Only take one extension version per GNOME Shell major version (as per `supported_versions`)
     - Filter out versions that only support old GNOME versions
     - Download the extension and hash it
     """
 
-    # Determine extension version per shell version
-    extension_versions: Dict[ShellVersion, ExtensionVersion] = {}
-    for shell_version, version_prefix in supported_versions.items():
-        # Newest compatible extension version
-        extension_version: Optional[int] = max(
-            (
-                int(ext_ver)
-                for shell_ver, ext_ver in extension_version_map.items()
-                if (shell_ver.startswith(version_prefix))
-            ),
-            default=None,
-        )
-        # Extension is not compatible with this GNOME version
-        if not extension_version:
-            continue
-
-        extension_versions[shell_version] = extension_version
-
-    # Download information once for all extension versions chosen above
-    extension_info_cache: Dict[ExtensionVersion, Tuple[str, str]] = {}
-    for extension_version in sorted(set(extension_versions.values())):
-        logging.debug(
-            f"[{uuid}] Downloading v{extension_version}"
-        )
-        extension_info_cache[extension_version] = \
-            fetch_extension_data(uuid, str(extension_version))
+    # Newest compatible extension version per shell version, determined in a single pass
+    newest_versions: Dict[ShellVersion, ExtensionVersion] = defaultdict(int)
+    for shell_ver, ext_data in extension_version_map.items():
+        shell_version = shell_version_by_prefix.get(version_prefix(shell_ver))
+        if shell_version:
+            newest_versions[shell_version] = max(newest_versions[shell_version], int(ext_data["version"]))
+
+    # Keep the order of `supported_versions`, and skip GNOME versions the extension is not compatible with
+    extension_versions: Dict[ShellVersion, ExtensionVersion] = {
+        shell_version: newest_versions[shell_version]
+        for shell_version in supported_versions
+        if newest_versions.get(shell_version)
+    }
+
+    # Extension is not compatible with any supported GNOME version
+    if not extension_versions:
+        return {}
+
+    # Download information once for all extension versions chosen above, concurrently
+    unique_versions = list(dict.fromkeys(extension_versions.values()))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(unique_versions)) as executor:
+        try:
+            extension_info_cache: Dict[ExtensionVersion, Tuple[str, str]] = dict(
+                zip(unique_versions, executor.map(lambda v: fetch_extension_data(uuid, str(v)), unique_versions))
+            )
+        except BaseException:
+            # Don't start any more downloads once one of them failed
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
 
     # Fill map
     extension_versions_full: Dict[ShellVersion, Dict[str, str]] = {}
@@ -136,13 +236,28 @@ def generate_extension_versions(
     return extension_versions_full
 
 
+@functools.lru_cache(maxsize=None)
 def pname_from_url(url: str) -> Tuple[str, str]:
     """
     Parse something like "/extension/1475/battery-time/" and output ("battery-time", "1475")
     """
 
-    url = url.split("/")  # type: ignore
-    return url[3], url[2]
+    match = extension_link_pattern.match(url)
+    if not match:
+        raise ValueError(f"Unexpected extension link: {url}")
+    return match.group(2), match.group(1)
+
+
+def register_package_name(extension: Dict[str, Any]) -> None:
+    """
+    Record the pname of a processed extension in `package_name_registry` for each of its shell versions.
+    This must be called from the main thread, in historical order, to keep the registry deterministic.
+    """
+    uuid = extension["uuid"]
+    pname = extension["pname"]
+
+    for shell_version in extension["shell_version_map"].keys():
+        package_name_registry[shell_version][pname].append(uuid)
 
 
 def process_extension(extension: Dict[str, Any]) -> Optional[Dict[str, Any]]:
@@ -195,12 +310,10 @@ def process_extension(extension: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     logging.info(f"Processing '{uuid}'")
 
     # Input is a mapping str -> { version: int, … }
-    # We want to map shell versions to extension versions
-    shell_version_map: Dict[ShellVersion, int] = {
-        k: v["version"] for k, v in extension["shell_version_map"].items()
-    }
     # Transform shell_version_map to be more useful for us. Also throw away unwanted versions
-    shell_version_map: Dict[ShellVersion, Dict[str, str]] = generate_extension_versions(shell_version_map, uuid)  # type: ignore
+    shell_version_map: Dict[ShellVersion, Dict[str, str]] = generate_extension_versions(
+        extension["shell_version_map"], uuid
+    )
 
     # No compatible versions found
     if not shell_version_map:
@@ -209,13 +322,6 @@ def process_extension(extension: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     # Fetch a human-readable name for the package.
     (pname, _pname_id) = pname_from_url(extension["link"])
 
-    for shell_version in shell_version_map.keys():
-        if pname in package_name_registry[shell_version]:
-            logging.warning(f"Package name '{pname}' for GNOME '{shell_version}' is colliding.")
-            package_name_registry[shell_version][pname].append(uuid)
-        else:
-            package_name_registry[shell_version][pname] = [uuid]
-
     return {
         "uuid": uuid,
         "name": extension["name"],
@@ -226,55 +332,93 @@ def process_extension(extension: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     }
 
 
+def dumps_object(obj: Dict[str, Any]) -> bytes:
+    """
+    Serialize a flat JSON object on a single line, in the same format as `json.dumps`.
+    orjson doesn't support the ", " and ": " separators, so only the keys and values are encoded by it.
+    """
+    return b"{" + b", ".join(
+        orjson.dumps(key) + b": " + orjson.dumps(value) for key, value in obj.items()
+    ) + b"}"
+
+
+def dump_extension(extension: Dict[str, Any], out: BinaryIO) -> None:
+    """
+    Write a processed extension as JSON. All attributes go on a single line, except for the supported versions,
+    which get one line each. The closing braces of the version map and the extension go on a line of their own.
+    """
+    attributes = {k: v for k, v in extension.items() if k != "shell_version_map"}
+    # Leave the object open, the version map is appended manually
+    out.write(dumps_object(attributes)[:-1])
+    out.write(b', "shell_version_map": {\n    ')
+    out.write(b",\n    ".join(
+        orjson.dumps(shell_version) + b": " + dumps_object(data)
+        for shell_version, data in extension["shell_version_map"].items()
+    ))
+    out.write(b"\n  }}")
+
+
 @contextmanager
 def request(url: str, retries: int = 5, retry_codes: List[int] = [ 500, 502, 503, 504 ]):
-    for attempt in range(retries + 1):
-        try:
-            with urllib.request.urlopen(url) as response:
-                yield response
-                break
-        except urllib.error.HTTPError as e:
-            if e.code in retry_codes and attempt < retries:
-                logging.warning(f"Error while fetching {url}. Retrying: {e}")
-            else:
-                raise e
+    response = http_pool.request(
+        "GET",
+        url,
+        preload_content=False,
+        retries=urllib3.Retry(total=retries, status_forcelist=retry_codes, backoff_factor=0.5),
+    )
+    try:
+        yield response
+    finally:
+        # Read any unconsumed body (e.g. of a 404), otherwise the connection can't be reused
+        response.drain_conn()
+        response.release_conn()
+
+
+def fetch_extensions_page(page: int) -> Optional[List[Dict[str, Any]]]:
+    """
+    Fetch a single page of the extensions index. Returns None if the page does not exist.
+    """
+    logging.info("Scraping page " + str(page))
+    url = f"https://extensions.gnome.org/extension-query/?n_per_page=25&page={page}"
+    with request(url) as response:
+        if response.status == 404:
+            return None
+        if response.status != 200:
+            raise Exception(f"Failed to fetch {url}: HTTP {response.status}")
+        return orjson.loads(response.read())["extensions"]
 
 
 def scrape_extensions_index() -> List[Dict[str, Any]]:
     """
-    Scrape the list of extensions by sending search queries to the API. We simply go over it
-    page by page until we hit a non-full page or a 404 error.
+    Scrape the list of extensions by sending search queries to the API. We go over it page by page until we
+    hit a non-full page or a 404 error. As the total number of pages is unknown, a window of pages is
+    fetched concurrently and everything past the last page is discarded.
 
     The returned list is sorted by the age of the extension, in order to be deterministic.
     """
-    page = 0
+    window_size = 8
     extensions = []
-    while True:
-        page += 1
-        logging.info("Scraping page " + str(page))
-        try:
-
-            with request(
-                    f"https://extensions.gnome.org/extension-query/?n_per_page=25&page={page}"
-            ) as response:
-                data = json.loads(response.read().decode())["extensions"]
-                response_length = len(data)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=window_size) as executor:
+        first_page = 1
+        last_page_reached = False
+        while not last_page_reached:
+            pages = range(first_page, first_page + window_size)
+            for page, data in zip(pages, executor.map(fetch_extensions_page, pages)):
+                # We reached past the last page and are done now
+                if data is None:
+                    last_page_reached = True
+                    break
 
-                for extension in data:
-                    extensions.append(extension)
+                extensions.extend(data)
 
                 # If our page isn't "full", it must have been the last one
-                if response_length < 25:
+                if len(data) < 25:
                     logging.debug(
-                        f"\tThis page only has {response_length} entries, so it must be the last one."
+                        f"\tPage {page} only has {len(data)} entries, so it must be the last one."
                     )
+                    last_page_reached = True
                     break
-        except urllib.error.HTTPError as e:
-            if e.code == 404:
-                # We reached past the last page and are done now
-                break
-            else:
-                raise
+            first_page += window_size
 
     # `pk` is the primary key in the extensions.gnome.org database. Sorting on it will give us a stable,
     # deterministic ordering.
@@ -283,68 +427,92 @@ def scrape_extensions_index() -> List[Dict[str, Any]]:
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Update extensions.json and collisions.json")
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Ignore the download cache and extensions.json, and download and hash all extension versions again",
+    )
+    args = parser.parse_args()
+
     logging.basicConfig(level=logging.DEBUG)
 
+    if not args.refresh:
+        load_download_cache()
     raw_extensions = scrape_extensions_index()
 
     logging.info(f"Downloaded {len(raw_extensions)} extensions. Processing …")
+    # The work is dominated by network and subprocess waits, so process the extensions concurrently
+    results: Dict[int, Optional[Dict[str, Any]]] = {}
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+            futures = {
+                executor.submit(process_extension, raw_extension): index
+                for index, raw_extension in enumerate(raw_extensions)
+            }
+            try:
+                for num, future in enumerate(concurrent.futures.as_completed(futures)):
+                    results[futures[future]] = future.result()
+                    logging.debug(f"Processed {num + 1} / {len(raw_extensions)}")
+            except BaseException:
+                # Fail fast (also on Ctrl-C) instead of processing all remaining extensions first
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise
+    finally:
+        # Keep what we downloaded so far, even if the run failed
+        save_download_cache()
+
+    # Restore the historical order, which the package name registry relies on
     processed_extensions: List[Dict[str, Any]] = []
-    for num, raw_extension in enumerate(raw_extensions):
-        processed_extension = process_extension(raw_extension)
+    for index in sorted(results.keys()):
+        processed_extension = results[index]
         if processed_extension:
+            register_package_name(processed_extension)
             processed_extensions.append(processed_extension)
-            logging.debug(f"Processed {num + 1} / {len(raw_extensions)}")
+
+    # The writer below relies on there being at least one extension to produce valid JSON
+    if not processed_extensions:
+        raise Exception("No extensions were processed, not overwriting extensions.json. Exiting.")
 
     # We micro-manage a lot of the serialization process to keep the diffs optimal.
     # We generally want most of the attributes of an extension on one line,
     # but then each of its supported versions with metadata on a new line.
-    with open(updater_dir_path / "extensions.json", "w") as out:
+    # Write bytes through a large buffer, there are many small writes per extension
+    with open(updater_dir_path / "extensions.json", "wb", buffering=1 << 20) as out:
         for index, extension in enumerate(processed_extensions):
             # Manually pretty-print the outermost array level
             if index == 0:
-                out.write("[ ")
+                out.write(b"[ ")
             else:
-                out.write(", ")
-            # Dump each extension into a single-line string forst
-            extension = json.dumps(extension, ensure_ascii=False)
-            # Inject line breaks for each supported version
-            for version in supported_versions:
-                # This one only matches the first entry
-                extension = extension.replace(f"{{\"{version}\": {{", f"{{\n    \"{version}\": {{")
-                # All other entries
-                extension = extension.replace(f", \"{version}\": {{", f",\n    \"{version}\": {{")
-            # One last line break around the closing braces
-            extension = extension.replace("}}}", "}\n  }}")
-
-            out.write(extension)
-            out.write("\n")
-        out.write("]\n")
+                out.write(b", ")
+            dump_extension(extension, out)
+            out.write(b"\n")
+        out.write(b"]\n")
 
     logging.info(
         f"Done. Writing results to extensions.json ({len(processed_extensions)} extensions in total)"
     )
 
-    with open(updater_dir_path / "extensions.json", "r") as out:
-        # Check that the generated file actually is valid JSON, just to be sure
-        json.load(out)
+    for shell_version, pnames in package_name_registry.items():
+        for pname, uuids in pnames.items():
+            if len(uuids) > 1:
+                logging.warning(f"Package name '{pname}' for GNOME '{shell_version}' is colliding.")
 
-    with open(updater_dir_path / "collisions.json", "w") as out:
+    with open(updater_dir_path / "collisions.json", "wb") as out:
         # Find the name collisions only for the last 3 shell versions
         last_3_versions = sorted(supported_versions.keys(), key=lambda v: float(v), reverse=True)[:3]
-        package_name_registry_for_versions = [v for k, v in package_name_registry.items() if k in last_3_versions]
         # Merge all package names into a single dictionary
-        package_name_registry_filtered: Dict[PackageName, Set[Uuid]] = {}
-        for pkgs in package_name_registry_for_versions:
-            for pname, uuids in pkgs.items():
-                if pname not in package_name_registry_filtered:
-                    package_name_registry_filtered[pname] = set()
-                package_name_registry_filtered[pname].update(uuids)
-        # Filter out those that are not duplicates
-        package_name_registry_filtered = {k: v for k, v in package_name_registry_filtered.items() if len(v) > 1}
-        # Convert set to list
-        collisions: Dict[PackageName, List[Uuid]] = {k: list(v) for k, v in package_name_registry_filtered.items()}
-        json.dump(collisions, out, indent=2, ensure_ascii=False)
-        out.write("\n")
+        package_name_registry_merged: DefaultDict[PackageName, Set[Uuid]] = defaultdict(set)
+        for shell_version, pkgs in package_name_registry.items():
+            if shell_version in last_3_versions:
+                for pname, uuids in pkgs.items():
+                    package_name_registry_merged[pname].update(uuids)
+        # Keep only the duplicates, sorted to keep the diffs stable
+        collisions: Dict[PackageName, List[Uuid]] = {
+            k: sorted(v) for k, v in package_name_registry_merged.items() if len(v) > 1
+        }
+        out.write(orjson.dumps(collisions, option=orjson.OPT_INDENT_2))
+        out.write(b"\n")
 
     logging.info(
         "Done. Writing name collisions to collisions.json (please check manually)"